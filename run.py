@@ -5,9 +5,10 @@ import asyncio
 # Add 'src' to sys.path to allow imports like 'from iron_business_hostess...'
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), 'src')))
 
-from iron_business_hostess.main import main
+from iron_business_hostess.main import configure_event_loop, main
 
 if __name__ == '__main__':
+    configure_event_loop()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -1,6 +1,15 @@
+import functools
 import os
 import yaml
 
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+_BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_TABLES_YAML = os.path.join(_BASE_DIR, "tables.yaml")
+
 class Config:
     # Telegram API credentials
     API_ID = int(os.getenv("TG_API_ID", "1234567"))
@@ -11,18 +20,47 @@ class Config:
     LLM_API_KEY = os.getenv("LLM_API_KEY", "sk-or-...") 
     LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://openrouter.ai/api/v1")
     LLM_MODEL = os.getenv("LLM_MODEL", "x-ai/grok-4.1-fast:free")
+    # Optional cheaper model tried first; it may only answer greetings and off-topic chat,
+    # and only when it gives the intent at least LLM_CHEAP_MIN_CONFIDENCE probability
+    LLM_MODEL_CHEAP = os.getenv("LLM_MODEL_CHEAP", "")
+    LLM_CHEAP_MIN_CONFIDENCE = float(os.getenv("LLM_CHEAP_MIN_CONFIDENCE", "0.85"))
+    # Provider-side prompt cache key for the static system prompt (OpenAI's prompt_cache_key).
+    # Off by default: set it only for a provider known to accept the field
+    LLM_PROMPT_CACHE_KEY = os.getenv("LLM_PROMPT_CACHE_KEY", "")
+    # How many tool-free LLM answers to keep for repeated messages
+    LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "512"))
+    # Semantic cache: reuse a greeting/small-talk answer for a paraphrased message (0 disables
+    # it, capped at 256 entries; needs an embeddings endpoint at LLM_BASE_URL)
+    LLM_SEMANTIC_CACHE_SIZE = int(os.getenv("LLM_SEMANTIC_CACHE_SIZE", "0"))
+    LLM_SEMANTIC_CACHE_THRESHOLD = float(os.getenv("LLM_SEMANTIC_CACHE_THRESHOLD", "0.93"))
+    LLM_EMBEDDING_MODEL = os.getenv("LLM_EMBEDDING_MODEL", "text-embedding-3-small")
+    # HTTP connection pool shared by all LLM requests
+    LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+    LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "50"))
+    LLM_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("LLM_KEEPALIVE_EXPIRY_SECONDS", "120"))
+    LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+    LLM_CONNECT_TIMEOUT_SECONDS = float(os.getenv("LLM_CONNECT_TIMEOUT_SECONDS", "5"))
+    # Chat completions allowed in flight at once, and per minute (0 = no rate limit)
+    LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+    LLM_RPM = int(os.getenv("LLM_RPM", "0"))
+
+    # Pause briefly with a typing action before each reply to look more human
+    HUMAN_DELAY_ENABLED = os.getenv("HUMAN_DELAY_ENABLED", "false").lower() == "true"
 
     # Timezone
     TIMEZONE = "Europe/Moscow"
     SLOT_DURATION_MINUTES = 30
 
-    @classmethod
-    def get_tables(cls):
-        base_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-        yaml_path = os.path.join(base_path, "tables.yaml")
+    # Database: keep reservations in memory and snapshot them to disk periodically
+    DB_IN_MEMORY = os.getenv("DB_IN_MEMORY", "false").lower() == "true"
+    DB_PERSIST_INTERVAL_SECONDS = int(os.getenv("DB_PERSIST_INTERVAL_SECONDS", "60"))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def get_tables():
         try:
-            with open(yaml_path, 'r', encoding='utf-8') as f:
-                data = yaml.safe_load(f)
+            with open(_TABLES_YAML, 'r', encoding='utf-8') as f:
+                data = yaml.load(f, Loader=_YamlLoader)
                 return data.get('tables', [])
         except Exception as e:
             print(f"Error loading tables.yaml: {e}")
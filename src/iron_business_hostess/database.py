@@ -1,38 +1,211 @@
+import asyncio
 import sqlite3
-import pytz
 from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional
+from zoneinfo import ZoneInfo
 import os
+import threading
+from contextlib import contextmanager
+
+# Настройки соединения: WAL вместо rollback-журнала, fsync только на чекпоинтах,
+# 64 МБ кэша страниц и mmap для чтения без лишних копий.
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=30000000000",
+    # Столики перезаливаются на месте (см. _init_db), поэтому ссылки броней можно проверять
+    "PRAGMA foreign_keys=ON",
+)
+
+# Размер кэша подготовленных выражений на соединение (по умолчанию в sqlite3 — 128)
+_CACHED_STATEMENTS = 256
+
+# Версия схемы в PRAGMA user_version, старые базы доводятся до неё при запуске:
+# 1 — слоты хранятся как Unix time (INTEGER), а не строками ISO;
+# 2 — у столиков есть флаг active (столики, убранные из tables.yaml, но с бронями)
+_SCHEMA_VERSION = 2
+
+# Горячие запросы вынесены в константы: sqlite3 кэширует подготовленные выражения по тексту SQL
+# Столики из конфигурации обновляются на месте: брони продолжают ссылаться на те же id
+_SQL_UPSERT_TABLE = (
+    "INSERT INTO tables (id, name, capacity, zone, active) VALUES (?, ?, ?, ?, 1) "
+    "ON CONFLICT(id) DO UPDATE SET "
+    "name = excluded.name, capacity = excluded.capacity, zone = excluded.zone, active = 1"
+)
+
+# Найти подходящий столик (вместимость >= кол-во гостей), который не занят в это время
+_SQL_FIND_TABLE = '''
+    SELECT t.id FROM tables t
+    LEFT JOIN reservations r
+        ON r.table_id = t.id AND r.slot_datetime = ? AND r.status = 'confirmed'
+    WHERE t.active = 1 AND t.capacity >= ? AND r.table_id IS NULL
+    ORDER BY t.capacity ASC
+    LIMIT 1
+'''
+
+_SQL_INSERT_RESERVATION = (
+    "INSERT INTO reservations (table_id, slot_datetime, client_name, phone_number, guests_count, booked_at) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+_SQL_FIND_RESERVATION_AT = (
+    "SELECT id, guests_count FROM reservations WHERE phone_number = ? AND slot_datetime = ? AND status = 'confirmed'"
+)
+
+_SQL_FIND_LATEST_RESERVATION = (
+    "SELECT id, guests_count FROM reservations WHERE phone_number = ? AND status = 'confirmed' "
+    "ORDER BY slot_datetime DESC LIMIT 1"
+)
+
+# Перенос брони на свободный столик: если столика нет, подзапрос пуст и ничего не обновится
+_SQL_RESCHEDULE = '''
+    UPDATE reservations SET slot_datetime = ?, table_id = free.id, booked_at = ?
+    FROM (
+        SELECT t.id FROM tables t
+        LEFT JOIN reservations r
+            ON r.table_id = t.id AND r.slot_datetime = ? AND r.status = 'confirmed'
+        WHERE t.active = 1 AND t.capacity >= ? AND r.table_id IS NULL
+        ORDER BY t.capacity ASC
+        LIMIT 1
+    ) AS free
+    WHERE reservations.id = ?
+    RETURNING table_id
+'''
+
+_SQL_CANCEL_AT = (
+    "UPDATE reservations SET status = 'cancelled' WHERE phone_number = ? AND slot_datetime = ? AND status = 'confirmed' "
+    "RETURNING id"
+)
+
+# Подзапрос идёт по idx_res_phone_status в обратном порядке, без сканирования таблицы
+_SQL_CANCEL_LATEST = (
+    "UPDATE reservations SET status = 'cancelled' WHERE id = "
+    "(SELECT id FROM reservations WHERE phone_number = ? AND status = 'confirmed' ORDER BY slot_datetime DESC LIMIT 1) "
+    "RETURNING id"
+)
+
+# Сколько слотов в каждую сторону от запрошенного времени просматривать в поиске альтернатив
+_ALTERNATIVES_MAX_OFFSET = 23
+
+# Все кандидаты проверяются одним запросом; dist задаёт порядок перебора (-1, +1, -2, +2, ...)
+_SQL_ALTERNATIVES = '''
+    WITH candidates(slot_dt, dist) AS (VALUES {values})
+    SELECT dist FROM candidates c
+    WHERE EXISTS (
+        SELECT 1 FROM tables t
+        LEFT JOIN reservations r
+            ON r.table_id = t.id AND r.slot_datetime = c.slot_dt AND r.status = 'confirmed'
+        WHERE t.active = 1 AND t.capacity >= ? AND r.table_id IS NULL
+    )
+    ORDER BY dist
+    LIMIT ?
+'''.format(values=", ".join(["(?, ?)"] * (_ALTERNATIVES_MAX_OFFSET * 2)))
 
 class ReservationDB:
-    def __init__(self, timezone_str: str, tables: List[Dict[str, Any]], slot_duration_minutes: int = 30, db_path: str = "reservations.db"):
-        self.timezone = pytz.timezone(timezone_str)
+    def __init__(self, timezone_str: str, tables: List[Dict[str, Any]], slot_duration_minutes: int = 30, db_path: str = "reservations.db", in_memory: bool = False):
+        self.timezone = ZoneInfo(timezone_str)
         self.slot_duration = timedelta(minutes=slot_duration_minutes)
+        self._slot_minutes = slot_duration_minutes
+        # Сдвиги для поиска альтернатив в порядке перебора: -1, +1, -2, +2, ... слота
+        self._alternative_offsets = [
+            self.slot_duration * offset * direction
+            for offset in range(1, _ALTERNATIVES_MAX_OFFSET + 1)
+            for direction in (-1, 1)
+        ]
         self.db_path = db_path
+        # В режиме in_memory база живёт в памяти, а db_path служит снимком на диске
+        self.in_memory = in_memory
         self.tables_config = tables
+        # Одно соединение на весь процесс: кэш страниц и подготовленных запросов
+        # переживает вызовы. Доступ из разных потоков сериализуется через блокировку.
+        self._lock = threading.RLock()
+        self._conn = self._get_connection()
         self._init_db()
 
     def _get_connection(self):
-        return sqlite3.connect(self.db_path)
+        if self.in_memory:
+            conn = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None, cached_statements=_CACHED_STATEMENTS)
+            # Поднимаем последний снимок, если он есть
+            if os.path.exists(self.db_path):
+                snapshot = sqlite3.connect(self.db_path)
+                try:
+                    snapshot.backup(conn)
+                finally:
+                    snapshot.close()
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, cached_statements=_CACHED_STATEMENTS)
+        # Большинство PRAGMA действуют только в рамках соединения
+        for pragma in _PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def persist(self):
+        """Сохраняет снимок базы в памяти в файл db_path"""
+        if not self.in_memory:
+            return
+        with self._lock:
+            snapshot = sqlite3.connect(self.db_path)
+            try:
+                self._conn.backup(snapshot)
+            finally:
+                snapshot.close()
+
+    async def persist_periodically(self, interval_seconds: float):
+        """Фоновая задача: раз в interval_seconds сохраняет снимок на диск"""
+        while True:
+            await asyncio.sleep(interval_seconds)
+            # Одна неудачная попытка (нет места, файл занят) не должна останавливать задачу
+            try:
+                await asyncio.to_thread(self.persist)
+            except Exception as e:
+                print(f"Error saving database snapshot to {self.db_path}: {e}")
+
+    @contextmanager
+    def _transaction(self):
+        """Пишущая транзакция: блокировка на запись берётся сразу (BEGIN IMMEDIATE)"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except BaseException:
+                # Неудачный COMMIT оставляет транзакцию открытой, и иначе все следующие
+                # BEGIN IMMEDIATE на общем соединении падали бы до перезапуска
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                raise
 
     def _init_db(self):
-        with self._get_connection() as conn:
+        with self._transaction() as conn:
             cursor = conn.cursor()
+            # Внешние ключи проверяются при COMMIT: переносу старых броней и заглушкам
+            # для удалённых столиков не мешают промежуточные состояния внутри транзакции
+            cursor.execute("PRAGMA defer_foreign_keys=ON")
+            schema_version = cursor.execute("PRAGMA user_version").fetchone()[0]
             # Таблица столиков
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS tables (
                     id INTEGER PRIMARY KEY,
                     name TEXT,
                     capacity INTEGER,
-                    zone TEXT
+                    zone TEXT,
+                    active INTEGER NOT NULL DEFAULT 1 -- 0: убран из tables.yaml, новые брони не принимает
                 )
             ''')
+            if schema_version < 2 and self._column_type(cursor, "tables", "active") is None:
+                cursor.execute("ALTER TABLE tables ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+            # База старого формата хранит слоты строками ISO: переносим её брони в новую таблицу
+            legacy = schema_version < 1 and self._column_type(cursor, "reservations", "slot_datetime") == "TEXT"
+            if legacy:
+                cursor.execute("ALTER TABLE reservations RENAME TO reservations_legacy")
             # Таблица для бронирований
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS reservations (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     table_id INTEGER,
-                    slot_datetime TEXT,
+                    slot_datetime INTEGER, -- начало слота, Unix time (UTC)
                     client_name TEXT,
                     phone_number TEXT,
                     guests_count INTEGER,
@@ -42,150 +215,182 @@ class ReservationDB:
                     UNIQUE(table_id, slot_datetime)
                 )
             ''')
+            if legacy:
+                self._migrate_text_slot_keys(cursor)
+            cursor.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+            # Индексы под поиск свободного столика и поиск брони по телефону
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_res_slot_status ON reservations(slot_datetime, status, table_id)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_res_phone_status ON reservations(phone_number, status, slot_datetime)"
+            )
             
-            # Предварительное заполнение столиков
-            cursor.execute("DELETE FROM tables")
-            for t in self.tables_config:
-                cursor.execute(
-                    "INSERT INTO tables (id, name, capacity, zone) VALUES (?, ?, ?, ?)",
-                    (t['id'], t['name'], t['capacity'], t['zone'])
-                )
-            conn.commit()
+            # Заполнение столиков из конфигурации
+            cursor.executemany(
+                _SQL_UPSERT_TABLE,
+                [(t['id'], t['name'], t['capacity'], t['zone']) for t in self.tables_config]
+            )
+            # Столики, убранные из конфигурации, выключаем; удаляем только те, на которые
+            # не ссылается ни одна бронь (в том числе отменённая)
+            configured_ids = [t['id'] for t in self.tables_config]
+            cursor.execute(
+                f"UPDATE tables SET active = 0 WHERE id NOT IN ({', '.join('?' * len(configured_ids))})",
+                configured_ids
+            )
+            cursor.execute(
+                "DELETE FROM tables WHERE active = 0 "
+                "AND NOT EXISTS (SELECT 1 FROM reservations r WHERE r.table_id = tables.id)"
+            )
+            # Брони из старых баз без внешних ключей могут ссылаться на давно удалённые столики:
+            # заводим для них выключенные записи, чтобы проверка внешних ключей прошла
+            cursor.execute(
+                "INSERT INTO tables (id, active) "
+                "SELECT DISTINCT table_id, 0 FROM reservations "
+                "WHERE table_id IS NOT NULL AND table_id NOT IN (SELECT id FROM tables)"
+            )
+
+        # Столики меняются только при старте, поэтому название и зону держим в памяти
+        self._tables_by_id = {t['id']: (t['name'], t['zone']) for t in self.tables_config}
+
+    @staticmethod
+    def _column_type(cursor: sqlite3.Cursor, table: str, column: str) -> Optional[str]:
+        """Объявленный тип столбца или None, если таблицы или столбца нет"""
+        for row in cursor.execute(f"PRAGMA table_info({table})").fetchall():
+            if row[1] == column:
+                return row[2].upper()
+        return None
+
+    def _migrate_text_slot_keys(self, cursor: sqlite3.Cursor):
+        """Переносит брони из reservations_legacy, переводя слоты из строк ISO в Unix time"""
+        rows = cursor.execute(
+            "SELECT id, table_id, slot_datetime, client_name, phone_number, guests_count, booked_at, status "
+            "FROM reservations_legacy"
+        ).fetchall()
+        migrated = []
+        for row in rows:
+            try:
+                slot_key = self._slot_key(datetime.fromisoformat(str(row[2])))
+            except ValueError:
+                raise RuntimeError(
+                    f"Не удалось перенести бронь id={row[0]} из {self.db_path}: "
+                    f"некорректное время слота {row[2]!r}"
+                ) from None
+            migrated.append((row[0], row[1], slot_key) + tuple(row[3:]))
+        cursor.executemany(
+            "INSERT INTO reservations "
+            "(id, table_id, slot_datetime, client_name, phone_number, guests_count, booked_at, status) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            migrated
+        )
+        # Вместе с таблицей удаляются и её старые индексы, освобождая их имена
+        cursor.execute("DROP TABLE reservations_legacy")
 
     def _normalize_datetime(self, dt: datetime) -> datetime:
         if dt.tzinfo is None:
-            dt = self.timezone.localize(dt)
+            dt = dt.replace(tzinfo=self.timezone)
         else:
             dt = dt.astimezone(self.timezone)
-        minute = (dt.minute // 30) * 30
+        minute = (dt.minute // self._slot_minutes) * self._slot_minutes
         return dt.replace(minute=minute, second=0, microsecond=0)
 
+    def _slot_key(self, dt: datetime) -> int:
+        """Ключ слота в БД: время начала слота в секундах Unix time"""
+        return int(self._normalize_datetime(dt).timestamp())
+
     def find_available_table(self, requested_dt: datetime, guests_count: int = 2) -> Optional[int]:
-        normalized_dt = self._normalize_datetime(requested_dt).isoformat()
+        slot_key = self._slot_key(requested_dt)
         
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            # Найти подходящий столик (вместимость >= кол-во гостей), который не занят в это время
-            query = '''
-                SELECT id FROM tables 
-                WHERE capacity >= ? 
-                AND id NOT IN (
-                    SELECT table_id FROM reservations 
-                    WHERE slot_datetime = ? AND status = 'confirmed'
-                )
-                ORDER BY capacity ASC
-                LIMIT 1
-            '''
-            cursor.execute(query, (guests_count, normalized_dt))
-            result = cursor.fetchone()
+        with self._lock:
+            result = self._conn.execute(_SQL_FIND_TABLE, (slot_key, guests_count)).fetchone()
             return result[0] if result else None
 
     def book_slot(self, requested_dt: datetime, client_name: str, phone_number: str, guests_count: int = 2) -> Optional[Dict[str, Any]]:
-        table_id = self.find_available_table(requested_dt, guests_count)
-        if not table_id:
-            return None
-
         normalized_dt = self._normalize_datetime(requested_dt)
-        dt_str = normalized_dt.isoformat()
+        slot_key = int(normalized_dt.timestamp())
         booked_at_str = datetime.now(self.timezone).isoformat()
 
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO reservations (table_id, slot_datetime, client_name, phone_number, guests_count, booked_at) VALUES (?, ?, ?, ?, ?, ?)",
-                (table_id, dt_str, client_name, phone_number, guests_count, booked_at_str)
+        # Поиск столика и вставка в одной транзакции, чтобы слот не заняли между ними
+        with self._transaction() as conn:
+            table_id = self.find_available_table(normalized_dt, guests_count)
+            if not table_id:
+                return None
+
+            conn.execute(
+                _SQL_INSERT_RESERVATION,
+                (table_id, slot_key, client_name, phone_number, guests_count, booked_at_str)
             )
-            
-            cursor.execute("SELECT name, zone FROM tables WHERE id = ?", (table_id,))
-            table_info = cursor.fetchone()
-            conn.commit()
-            
-            return {
-                "datetime": normalized_dt,
-                "table_name": table_info[0],
-                "zone": table_info[1]
-            }
 
-    def get_alternative_slots(self, requested_dt: datetime, guests_count: int = 2, num_alternatives: int = 5) -> List[datetime]:
+        table_name, zone = self._tables_by_id[table_id]
+        return {
+            "datetime": normalized_dt,
+            "table_name": table_name,
+            "zone": zone
+        }
+
+    async def get_alternative_slots(self, requested_dt: datetime, guests_count: int = 2, num_alternatives: int = 5) -> List[datetime]:
+        # Запрос к SQLite блокирует поток, поэтому выполняем его в пуле потоков,
+        # чтобы event loop продолжал обслуживать другие чаты
+        return await asyncio.to_thread(self._query_alternatives, requested_dt, guests_count, num_alternatives)
+
+    def _query_alternatives(self, requested_dt: datetime, guests_count: int, num_alternatives: int) -> List[datetime]:
         normalized_dt = self._normalize_datetime(requested_dt)
-        alternatives: List[datetime] = []
-        
-        offset = 1
-        while len(alternatives) < num_alternatives and offset < 24:
-            # Проверяем слоты вокруг
-            for direction in [-1, 1]:
-                check_slot = normalized_dt + (self.slot_duration * offset * direction)
-                if self.find_available_table(check_slot, guests_count):
-                    alternatives.append(check_slot)
-                if len(alternatives) >= num_alternatives:
-                    break
-            offset += 1
-        
-        return sorted(alternatives)
+        # Проверяем слоты вокруг
+        candidates = [normalized_dt + delta for delta in self._alternative_offsets]
+        params: List[Any] = []
+        for dist, check_slot in enumerate(candidates):
+            params.extend((self._slot_key(check_slot), dist))
+        params.extend((guests_count, num_alternatives))
+
+        with self._lock:
+            rows = self._conn.execute(_SQL_ALTERNATIVES, params).fetchall()
+
+        return sorted(candidates[row[0]] for row in rows)
 
     def update_reservation_time(self, phone_number: str, old_dt: Optional[datetime], new_dt: datetime) -> Optional[Dict[str, Any]]:
         """Переносит существующую бронь на новое время"""
         normalized_new_dt = self._normalize_datetime(new_dt)
-        new_dt_str = normalized_new_dt.isoformat()
+        new_slot_key = int(normalized_new_dt.timestamp())
 
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            
+        with self._transaction() as conn:
             # 1. Найти существующую активную бронь
             if old_dt:
-                old_dt_str = self._normalize_datetime(old_dt).isoformat()
-                cursor.execute(
-                    "SELECT id, guests_count FROM reservations WHERE phone_number = ? AND slot_datetime = ? AND status = 'confirmed'",
-                    (phone_number, old_dt_str)
-                )
+                row = conn.execute(_SQL_FIND_RESERVATION_AT, (phone_number, self._slot_key(old_dt))).fetchone()
             else:
-                cursor.execute(
-                    "SELECT id, guests_count FROM reservations WHERE phone_number = ? AND status = 'confirmed' ORDER BY slot_datetime DESC LIMIT 1",
-                    (phone_number,)
-                )
+                row = conn.execute(_SQL_FIND_LATEST_RESERVATION, (phone_number,)).fetchone()
             
-            row = cursor.fetchone()
             if not row:
                 return None
             
             res_id, guests_count = row
 
-            # 2. Проверить доступность нового слота
-            table_id = self.find_available_table(normalized_new_dt, guests_count)
-            if not table_id:
+            # 2. Перенести бронь на свободный столик одним запросом; гонку за слот отсечёт UNIQUE
+            try:
+                updated = conn.execute(
+                    _SQL_RESCHEDULE,
+                    (new_slot_key, datetime.now(self.timezone).isoformat(), new_slot_key, guests_count, res_id)
+                ).fetchone()
+            except sqlite3.IntegrityError:
                 return None
+            if not updated:
+                return None
+            table_id = updated[0]
 
-            # 3. Обновить бронь
-            cursor.execute(
-                "UPDATE reservations SET slot_datetime = ?, table_id = ?, booked_at = ? WHERE id = ?",
-                (new_dt_str, table_id, datetime.now(self.timezone).isoformat(), res_id)
-            )
-            
-            cursor.execute("SELECT name, zone FROM tables WHERE id = ?", (table_id,))
-            table_info = cursor.fetchone()
-            conn.commit()
-
-            return {
-                "datetime": normalized_new_dt,
-                "table_name": table_info[0],
-                "zone": table_info[1],
-                "guests_count": guests_count
-            }
+        table_name, zone = self._tables_by_id[table_id]
+        return {
+            "datetime": normalized_new_dt,
+            "table_name": table_name,
+            "zone": zone,
+            "guests_count": guests_count
+        }
 
     def cancel_reservation(self, phone_number: str, requested_dt: Optional[datetime] = None) -> bool:
         """Отменяет последнее бронирование по номеру телефона (или конкретное по времени)"""
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
+        with self._transaction() as conn:
             if requested_dt:
-                dt_str = self._normalize_datetime(requested_dt).isoformat()
-                cursor.execute(
-                    "UPDATE reservations SET status = 'cancelled' WHERE phone_number = ? AND slot_datetime = ? AND status = 'confirmed'",
-                    (phone_number, dt_str)
-                )
+                cursor = conn.execute(_SQL_CANCEL_AT, (phone_number, self._slot_key(requested_dt)))
             else:
-                cursor.execute(
-                    "UPDATE reservations SET status = 'cancelled' WHERE id = (SELECT id FROM reservations WHERE phone_number = ? AND status = 'confirmed' ORDER BY slot_datetime DESC LIMIT 1)",
-                    (phone_number,)
-                )
-            conn.commit()
-            return cursor.rowcount > 0
+                cursor = conn.execute(_SQL_CANCEL_LATEST, (phone_number,))
+            # Бронь на тот же слот может быть не одна: RETURNING нужно дочитать до конца,
+            # иначе COMMIT упадёт с незавершённым выражением
+            return bool(cursor.fetchall())
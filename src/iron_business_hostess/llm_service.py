@@ -1,23 +1,276 @@
+import asyncio
+import contextlib
+import functools
+import hashlib
 import json
+import math
+import operator
 import re
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+import time as _clock
+from collections import OrderedDict, deque
+from datetime import date, datetime, time, timedelta
+from typing import Optional, Dict, Any, AsyncIterator, List, Tuple
+from zoneinfo import ZoneInfo
 
-import pytz
+import httpx
 from openai import AsyncOpenAI
-from openai.types.chat import ChatCompletionMessageToolCall
-from openai.types.chat.chat_completion_message import ChatCompletionMessage
 
 from iron_business_hostess.config import Config
 
+# orjson is optional; it serializes tool results and parses tool arguments several
+# times faster than the stdlib. Its JSONDecodeError subclasses json.JSONDecodeError.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    def _json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    _json_loads = orjson.loads
+else:
+    _json_dumps = json.dumps
+    _json_loads = json.loads
+
+# Date parsing tables, built once at import instead of on every _parse_date call
+_MONTH_RE = re.compile(
+    r"(\d{1,2})\s+(января|февраля|марта|апреля|мая|июня|июля|августа|сентября|октября|ноября|декабря)",
+    re.IGNORECASE,
+)
+# The regex only matches full month names, and their first three letters are unique
+_MONTH_BY_PREFIX = {
+    "янв": 1, "фев": 2, "мар": 3, "апр": 4, "мая": 5, "июн": 6,
+    "июл": 7, "авг": 8, "сен": 9, "окт": 10, "ноя": 11, "дек": 12
+}
+_RELATIVE = {"сегодня": 0, "завтра": 1, "послезавтра": 2}
+_MIDNIGHT = datetime.min.time()
+
+# Restaurant timezone; looked up once instead of on every tool call
+_TZ = ZoneInfo(Config.TIMEZONE)
+
+
+# (monotonic time it was computed, restaurant-local date)
+_TODAY_CACHE: Tuple[float, Optional[date]] = (float("-inf"), None)
+
+
+def _today() -> date:
+    """Restaurant-local date, recomputed at most once per second.
+
+    A burst of messages shares one clock read; the short TTL keeps the value
+    correct right after midnight.
+    """
+    global _TODAY_CACHE
+    now = _clock.monotonic()
+    computed_at, today = _TODAY_CACHE
+    if today is None or now - computed_at > 1.0:
+        today = datetime.now(_TZ).date()
+        _TODAY_CACHE = (now, today)
+    return today
+
+
+# Messages made only of greetings, thanks and goodbyes (e.g. "Привет!", "Спасибо, до свидания").
+# Anything more (a greeting followed by a request, a question) still goes to the LLM.
+_GREETING_ONLY_RE = re.compile(
+    r"(?:[\s!.,:()]*(?:привет(?:ствую)?|здравствуй(?:те)?|добр(?:ый|ое|ого|ой)\s+(?:день|дня|вечер|вечера|утро|утра|ночи)"
+    r"|спасибо|благодарю|до\s+свидания|пока|hello|hi|thanks?))+[\s!.,:()]*",
+    re.IGNORECASE,
+)
+
+
+def _local_classify(text: str) -> Optional[Dict[str, Any]]:
+    """Classifies messages that do not need the LLM, or returns None."""
+    if _GREETING_ONLY_RE.fullmatch(text):
+        return {"intent": "greeting"}
+    return None
+
+
+# The intent value at the start of a structured answer, e.g. {"intent": "greeting", ...}
+_INTENT_VALUE_RE = re.compile(r'\s*\{\s*"intent"\s*:\s*"([^"]*)"')
+
+
+def _intent_confidence(choice: Any) -> float:
+    """Probability the model gave the intent value, from the logprobs of the tokens spelling it."""
+    content = choice.message.content or ""
+    match = _INTENT_VALUE_RE.match(content)
+    tokens = choice.logprobs.content if choice.logprobs else None
+    if match is None or not tokens:
+        return 0.0
+    start, end = match.span(1)
+    offset, logprob = 0, 0.0
+    for token in tokens:
+        token_end = offset + len(token.token)
+        if token_end > start and offset < end:
+            logprob += token.logprob
+        offset = token_end
+        if offset >= end:
+            break
+    return math.exp(logprob)
+
+
+# Static system prompt, built once; the client's message is sent separately as the user
+# turn, so the prefix is identical across requests and the provider can cache it
+_SYSTEM_PROMPT = """Ты - хостесс ресторана. Твоя задача - определить намерение клиента и извлечь необходимую информацию.
+
+Возможные намерения:
+- `greeting`: Если клиент просто здоровается, благодарит или прощается.
+- `booking_intent`: Если клиент хочет забронировать столик.
+- `cancel_intent`: Если клиент хочет отменить бронирование.
+- `change_intent`: Если клиент хочет перенести или изменить бронирование на другое время.
+- `other`: Во всех остальных случаях.
+
+Если намерение `booking_intent`, извлеки: дату, время, имя клиента, номер телефона и КОЛИЧЕСТВО ГОСТЕЙ (guests_count, по умолчанию 2).
+Если намерение `cancel_intent`, извлеки: номер телефона и (опционально) дату.
+Если намерение `change_intent`, извлеки: номер телефона, новую дату (new_date) и новое время (new_time).
+
+Для проверки свободных столиков, бронирования, отмены и переноса брони используй соответствующие инструменты (tools).
+Относительные даты ("сегодня", "завтра", "послезавтра") передавай как есть, время - в формате HH:MM.
+Если для бронирования не хватает имени или номера телефона, не вызывай инструмент, а вежливо уточни недостающие данные.
+
+Информация о ресторане:
+1. График работы: ежедневно, с 8:00 до 24:00.
+2. Столики: есть в зале и на веранде. Всего 5 столов разной вместимости (от 2 до 8 человек).
+3. Парковка: есть возле ресторана.
+4. Дополнительные услуги: по выходным во второй половине дня играет живая музыка.
+5. Меню: большое количество блюд из кухонь разных народов мира, основной акцент на русской домашней кухне.
+
+На вопросы, не связанные с бронированием или рестораном, отвечай уклончиво и возвращай разговор к бронированию столика.
+
+Текст ответа клиенту пиши в поле `message`.
+"""
+_BASE_MESSAGES = ({"role": "system", "content": _SYSTEM_PROMPT},)
+# Routes requests sharing that prefix to the same provider-side prompt cache (OpenAI's
+# prompt_cache_key); only sent when LLM_PROMPT_CACHE_KEY is set, since other providers may reject it
+_PROMPT_CACHE_BODY = {"prompt_cache_key": Config.LLM_PROMPT_CACHE_KEY} if Config.LLM_PROMPT_CACHE_KEY else None
+
+# Bump whenever the prompt or tool schema changes, so answers produced by the old prompt are not reused
+_CACHE_VERSION = "3"
+
+# Upper bound on the semantic cache: every lookup is a linear scan over all stored embeddings
+_SEMANTIC_CACHE_MAX = 256
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_date_on(date_str: str, today: date) -> Optional[date]:
+    """Parses a date string relative to ``today``.
+
+    Kept at module level and memoized: the model emits a small set of date strings
+    ("завтра", "25.10", ...), so repeated turns skip the parsing entirely.
+    """
+    delta = _RELATIVE.get(date_str.lower())
+    if delta is not None:
+        return today + timedelta(days=delta)
+    
+    # Try to parse absolute date formats (e.g., '25 октября', '25.10', '25.10.2025')
+    # This part can be more robust, but for now, a simple approach.
+    try:
+        # '25 октября'
+        match = _MONTH_RE.match(date_str)
+        if match:
+            day = int(match.group(1))
+            month = _MONTH_BY_PREFIX.get(match.group(2)[:3].lower())
+            if month:
+                year = today.year
+                # If the month has already passed this year, assume next year
+                if month < today.month or (month == today.month and day < today.day):
+                    year += 1
+                return date(year, month, day)
+        
+        # '25.10' or '25.10.2025', split by hand instead of trying strptime formats
+        parts = date_str.split(".")
+        if (
+            len(parts) in (2, 3)
+            and all(part.isdecimal() for part in parts)
+            and len(parts[0]) <= 2 and len(parts[1]) <= 2
+            and (len(parts) == 2 or len(parts[2]) == 4)
+        ):
+            day, month = int(parts[0]), int(parts[1])
+            try:
+                if len(parts) == 3:
+                    return date(int(parts[2]), month, day)
+                # If year is not provided, assume current year
+                parsed_date = date(today.year, month, day)
+                # If the date has already passed this year, assume next year
+                if parsed_date < today:
+                    parsed_date = parsed_date.replace(year=today.year + 1)
+                return parsed_date
+            except ValueError:
+                return None
+    except Exception as e:
+        print(f"Error parsing date '{date_str}': {e}")
+        
+    return None
+
+
+class _RateLimiter:
+    """Token bucket allowing ``per_minute`` requests per minute, with bursts up to that many."""
+
+    def __init__(self, per_minute: int):
+        self._rate = per_minute / 60.0
+        self._capacity = float(per_minute)
+        self._tokens = float(per_minute)
+        self._updated = _clock.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        # The lock keeps waiters in FIFO order; the bucket is refilled lazily from the clock
+        async with self._lock:
+            while True:
+                now = _clock.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
 class LLMService:
+    # One client (and so one connection pool) per provider for the whole process
+    _clients: Dict[Tuple[str, str], AsyncOpenAI] = {}
+
     def __init__(self, api_key: str, base_url: str, db: Any):
         self.api_key = api_key
         self.base_url = base_url
         self.db = db
-        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+        self.client = self._get_client(api_key, base_url)
+        # LRU of parsed answers that did not involve a tool call, keyed by _cache_key(text)
+        self._response_cache: "OrderedDict[bytes, Dict[str, Any]]" = OrderedDict()
+        # Bounded FIFO of (unit embedding, parsed answer) for tool-free answers, searched by cosine similarity
+        self._semantic_cache: "deque[Tuple[List[float], Dict[str, Any]]]" = deque(
+            maxlen=min(Config.LLM_SEMANTIC_CACHE_SIZE, _SEMANTIC_CACHE_MAX)
+        )
+        # Bursts queue here instead of piling up in-flight completions at the provider
+        self._llm_semaphore = asyncio.Semaphore(Config.LLM_MAX_CONCURRENCY)
+        self._rate_limiter = _RateLimiter(Config.LLM_RPM) if Config.LLM_RPM > 0 else None
+        # Requests currently talking to the LLM, keyed like the cache; identical messages share one
+        self._inflight: Dict[bytes, "asyncio.Future[Dict[str, Any]]"] = {}
+
+    @classmethod
+    def _get_client(cls, api_key: str, base_url: str) -> AsyncOpenAI:
+        client = cls._clients.get((api_key, base_url))
+        if client is None:
+            # HTTP/2 multiplexes concurrent completions over one pooled connection to the provider
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=httpx.AsyncClient(
+                    http2=True,
+                    limits=httpx.Limits(
+                        max_connections=Config.LLM_MAX_CONNECTIONS,
+                        max_keepalive_connections=Config.LLM_MAX_KEEPALIVE_CONNECTIONS,
+                        # Keep idle connections longer than httpx's 5 s default, so quiet
+                        # chats do not pay a new TLS handshake on every message
+                        keepalive_expiry=Config.LLM_KEEPALIVE_EXPIRY_SECONDS,
+                    ),
+                    timeout=httpx.Timeout(Config.LLM_TIMEOUT_SECONDS, connect=Config.LLM_CONNECT_TIMEOUT_SECONDS),
+                ),
+            )
+            cls._clients[(api_key, base_url)] = client
+        return client
 
-    TOOLS = [
+    # Static tool schema, shared by every request; a tuple so it cannot be mutated per call
+    TOOLS = (
     {
         "type": "function",
         "function": {
@@ -122,55 +375,71 @@ class LLMService:
             },
         },
     },
-]
-
-    def _get_mock_llm_response(self, text: str) -> str:
-        # This is a mock LLM response for testing purposes
-        text_lower = text.lower()
-        if "забронировать" in text_lower and "сегодня" in text_lower and "18:00" in text_lower and "иван" in text_lower and "1234567890" in text_lower:
-            return json.dumps({"intent": "booking_intent", "date": "today", "time": "18:00", "client_name": "Иван", "phone_number": "+791234567890"})
-        elif "забронировать" in text_lower and "завтра" in text_lower and "20:30" in text_lower and "мария" in text_lower and "0987654321" in text_lower:
-            return json.dumps({"intent": "booking_intent", "date": "tomorrow", "time": "20:30", "client_name": "Мария", "phone_number": "+790987654321"})
-        elif "привет" in text_lower or "здравствуйте" in text_lower or "спасибо" in text_lower or "до свидания" in text_lower:
-            return json.dumps({"intent": "greeting"})
-        elif "как дела" in text_lower or "что нового" in text_lower:
-            return json.dumps({"intent": "other"})
-        return json.dumps({"intent": "other"})
-
-    def _check_slot_availability(self, date: str, time: str, guests_count: int = 2) -> str:
+)
+
+    # Structured output for answers that do not call a tool. In strict mode every field is
+    # required, so optional ones are nullable.
+    RESPONSE_FORMAT = {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "hostess_reply",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "intent": {
+                        "type": "string",
+                        "enum": ["greeting", "booking_intent", "cancel_intent", "change_intent", "other"],
+                    },
+                    "message": {"type": ["string", "null"], "description": "Текст ответа клиенту."},
+                    "date": {"type": ["string", "null"]},
+                    "time": {"type": ["string", "null"]},
+                    "client_name": {"type": ["string", "null"]},
+                    "phone_number": {"type": ["string", "null"]},
+                    "guests_count": {"type": ["integer", "null"]},
+                },
+                "required": ["intent", "message", "date", "time", "client_name", "phone_number", "guests_count"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+    async def _check_slot_availability(self, date: str, time: str, guests_count: int = 2) -> str:
         try:
             parsed_date = self._parse_date(date)
             parsed_time = self._parse_time(time)
             if not parsed_date or not parsed_time:
-                return json.dumps({"status": "error", "message": "Некорректный формат даты или времени."})
+                return _json_dumps({"status": "error", "message": "Некорректный формат даты или времени."})
 
-            reservation_datetime = pytz.timezone(Config.TIMEZONE).localize(
-                datetime.combine(parsed_date.date(), parsed_time.time())
-            )
+            reservation_datetime = datetime.combine(parsed_date, parsed_time, tzinfo=_TZ)
 
-            table_id = self.db.find_available_table(reservation_datetime, guests_count)
+            table_id = await asyncio.to_thread(self.db.find_available_table, reservation_datetime, guests_count)
             if table_id:
-                return json.dumps({"status": "available", "datetime": str(reservation_datetime), "guests_count": guests_count})
+                return _json_dumps({"status": "available", "datetime": str(reservation_datetime), "guests_count": guests_count})
             else:
-                alternatives = self.db.get_alternative_slots(reservation_datetime, guests_count)
-                return json.dumps({"status": "unavailable", "alternatives": [str(alt) for alt in alternatives]})
+                alternatives = await self.db.get_alternative_slots(reservation_datetime, guests_count)
+                return _json_dumps({
+                    "status": "unavailable",
+                    "datetime": str(reservation_datetime),
+                    "alternatives": [str(alt) for alt in alternatives],
+                })
         except Exception as e:
-            return json.dumps({"status": "error", "message": str(e)})
+            return _json_dumps({"status": "error", "message": str(e)})
 
-    def _book_slot(self, date: str, time: str, client_name: str, phone_number: str, guests_count: int = 2) -> str:
+    async def _book_slot(self, date: str, time: str, client_name: str, phone_number: str, guests_count: int = 2) -> str:
         try:
             parsed_date = self._parse_date(date)
             parsed_time = self._parse_time(time)
             if not parsed_date or not parsed_time:
-                return json.dumps({"status": "error", "message": "Некорректный формат даты или времени."})
+                return _json_dumps({"status": "error", "message": "Некорректный формат даты или времени."})
 
-            reservation_datetime = pytz.timezone(Config.TIMEZONE).localize(
-                datetime.combine(parsed_date.date(), parsed_time.time())
-            )
+            reservation_datetime = datetime.combine(parsed_date, parsed_time, tzinfo=_TZ)
 
-            result = self.db.book_slot(reservation_datetime, client_name, phone_number, guests_count)
+            result = await asyncio.to_thread(
+                self.db.book_slot, reservation_datetime, client_name, phone_number, guests_count
+            )
             if result:
-                return json.dumps({
+                return _json_dumps({
                     "status": "booked", 
                     "datetime": str(result["datetime"]), 
                     "client_name": client_name, 
@@ -180,37 +449,39 @@ class LLMService:
                     "guests_count": guests_count
                 })
             else:
-                return json.dumps({"status": "error", "message": "К сожалению, подходящих свободных столиков на это время нет."})
+                return _json_dumps({"status": "error", "message": "К сожалению, подходящих свободных столиков на это время нет."})
         except Exception as e:
-            return json.dumps({"status": "error", "message": str(e)})
+            return _json_dumps({"status": "error", "message": str(e)})
 
-    def _cancel_reservation(self, phone_number: str, date: Optional[str] = None) -> str:
+    async def _cancel_reservation(self, phone_number: str, date: Optional[str] = None) -> str:
         try:
             parsed_date = self._parse_date(date) if date else None
-            success = self.db.cancel_reservation(phone_number, parsed_date)
+            if parsed_date:
+                parsed_date = datetime.combine(parsed_date, _MIDNIGHT)
+            success = await asyncio.to_thread(self.db.cancel_reservation, phone_number, parsed_date)
             if success:
-                return json.dumps({"status": "cancelled", "phone_number": phone_number})
+                return _json_dumps({"status": "cancelled", "phone_number": phone_number})
             else:
-                return json.dumps({"status": "error", "message": "Бронирование не найдено."})
+                return _json_dumps({"status": "error", "message": "Бронирование не найдено."})
         except Exception as e:
-            return json.dumps({"status": "error", "message": str(e)})
+            return _json_dumps({"status": "error", "message": str(e)})
 
-    def _change_reservation(self, phone_number: str, new_date: str, new_time: str, old_date: Optional[str] = None) -> str:
+    async def _change_reservation(self, phone_number: str, new_date: str, new_time: str, old_date: Optional[str] = None) -> str:
         try:
             parsed_new_date = self._parse_date(new_date)
             parsed_new_time = self._parse_time(new_time)
             parsed_old_date = self._parse_date(old_date) if old_date else None
+            if parsed_old_date:
+                parsed_old_date = datetime.combine(parsed_old_date, _MIDNIGHT)
             
             if not parsed_new_date or not parsed_new_time:
-                return json.dumps({"status": "error", "message": "Некорректный формат новой даты или времени."})
+                return _json_dumps({"status": "error", "message": "Некорректный формат новой даты или времени."})
 
-            new_dt = pytz.timezone(Config.TIMEZONE).localize(
-                datetime.combine(parsed_new_date.date(), parsed_new_time.time())
-            )
+            new_dt = datetime.combine(parsed_new_date, parsed_new_time, tzinfo=_TZ)
 
-            result = self.db.update_reservation_time(phone_number, parsed_old_date, new_dt)
+            result = await asyncio.to_thread(self.db.update_reservation_time, phone_number, parsed_old_date, new_dt)
             if result:
-                return json.dumps({
+                return _json_dumps({
                     "status": "changed", 
                     "datetime": str(result["datetime"]), 
                     "phone_number": phone_number,
@@ -218,128 +489,247 @@ class LLMService:
                     "zone": result["zone"]
                 })
             else:
-                return json.dumps({"status": "error", "message": "Бронирование не найдено или новое время уже занято."})
+                return _json_dumps({"status": "error", "message": "Бронирование не найдено или новое время уже занято."})
+        except Exception as e:
+            return _json_dumps({"status": "error", "message": str(e)})
+
+    # Tool name -> handler, built once with the class rather than per request
+    _TOOL_DISPATCH = {
+        "check_slot_availability": _check_slot_availability,
+        "book_slot": _book_slot,
+        "cancel_reservation": _cancel_reservation,
+        "change_reservation": _change_reservation,
+    }
+
+    def _cache_key(self, text: str) -> bytes:
+        key = f"{_CACHE_VERSION}\0{Config.LLM_MODEL}\0{text.strip().lower()}"
+        return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+    def _cache_response(self, key: bytes, parsed_data: Dict[str, Any]):
+        self._response_cache[key] = parsed_data
+        if len(self._response_cache) > Config.LLM_CACHE_SIZE:
+            self._response_cache.popitem(last=False)
+
+    async def warm_up(self):
+        """Opens the pooled connection to the provider before the first message arrives."""
+        try:
+            await self.client.models.list()
         except Exception as e:
-            return json.dumps({"status": "error", "message": str(e)})
+            print(f"Error warming up LLM connection: {e}")
+
+    @contextlib.asynccontextmanager
+    async def _llm_slot(self) -> AsyncIterator[None]:
+        """Holds a concurrency slot (and a rate-limit token) for one chat completion."""
+        if self._rate_limiter is not None:
+            await self._rate_limiter.acquire()
+        async with self._llm_semaphore:
+            yield
+
+    async def _embed(self, text: str) -> Optional[List[float]]:
+        """Unit-length embedding of the message, or None if it could not be computed."""
+        try:
+            response = await self.client.embeddings.create(model=Config.LLM_EMBEDDING_MODEL, input=text.strip())
+        except Exception as e:
+            print(f"Error computing embedding: {e}")
+            return None
+        vector = response.data[0].embedding
+        norm = math.hypot(*vector)
+        return [x / norm for x in vector] if norm else None
+
+    @staticmethod
+    def _find_similar(
+        embedding: List[float], entries: List[Tuple[List[float], Dict[str, Any]]]
+    ) -> Optional[Dict[str, Any]]:
+        best_score, best_answer = Config.LLM_SEMANTIC_CACHE_THRESHOLD, None
+        for cached_embedding, answer in entries:
+            # Both vectors are unit length, so the dot product is the cosine similarity
+            score = sum(map(operator.mul, embedding, cached_embedding))
+            if score > best_score:
+                best_score, best_answer = score, answer
+        return best_answer
 
     async def parse_reservation_request(self, text: str) -> Dict[str, Any]:
-        messages = [
-            {"role": "system", "content": f"""Ты - хостесс ресторана. Твоя задача - определить намерение клиента и извлечь необходимую информацию.
-            
-            Возможные намерения:
-            - `greeting`: Если клиент просто здоровается, благодарит или прощается.
-            - `booking_intent`: Если клиент хочет забронировать столик.
-            - `cancel_intent`: Если клиент хочет отменить бронирование.
-            - `change_intent`: Если клиент хочет перенести или изменить бронирование на другое время.
-            - `other`: Во всех остальных случаях.
-            
-            Если намерение `booking_intent`, извлеки: дату, время, имя клиента, номер телефона и КОЛИЧЕСТВО ГОСТЕЙ (guests_count, по умолчанию 2).
-            Если намерение `cancel_intent`, извлеки: номер телефона и (опционально) дату.
-            Если намерение `change_intent`, извлеки: номер телефона, новую дату (new_date) и новое время (new_time).
-...
-            Информация о ресторане:
-            1. График работы: ежедневно, с 8:00 до 24:00.
-            2. Столики: есть в зале и на веранде. Всего 5 столов разной вместимости (от 2 до 8 человек).
-            3. Парковка: есть возле ресторана.
-...
-        if tool_calls:
-            # Step 2: call the tool
-            available_functions = {
-                "check_slot_availability": self._check_slot_availability,
-                "book_slot": self._book_slot,
-                "cancel_reservation": self._cancel_reservation,
-                "change_reservation": self._change_reservation,
-            }
-            
-            # Only one tool call is expected for simplicity
-            tool_call = tool_calls[0]
-            function_name = tool_call.function.name
-            function_to_call = available_functions[function_name]
-            function_args = json.loads(tool_call.function.arguments)
-            
-            function_response = function_to_call(**function_args)
-            
-            # Step 3: send tool output back to LLM
-            messages.append(response_message)
-            messages.append(
-                {
-                    "tool_call_id": tool_call.id,
-                    "role": "tool",
-                    "name": function_name,
-                    "content": function_response,
-                }
-            )
-            
-            second_response = await self.client.chat.completions.create(
+        # Bare greetings get a canned reply, so both LLM round-trips can be skipped
+        quick = _local_classify(text)
+        if quick is not None:
+            return quick
+
+        # Answers that did not go through a tool depend only on the text, so repeats skip the LLM
+        cache_key = self._cache_key(text)
+        cached = self._response_cache.get(cache_key)
+        if cached is not None:
+            self._response_cache.move_to_end(cache_key)
+            return dict(cached)
+
+        # Coalesce concurrent identical messages (double sends, retries) into one LLM round-trip.
+        # shield() keeps the shared request alive if one of the waiting handlers is cancelled.
+        inflight = self._inflight.get(cache_key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._process_request(text, cache_key))
+            self._inflight[cache_key] = inflight
+            inflight.add_done_callback(lambda _: self._inflight.pop(cache_key, None))
+        return dict(await asyncio.shield(inflight))
+
+    async def _process_request(self, text: str, cache_key: bytes) -> Dict[str, Any]:
+        # Semantic tier: a paraphrase of an earlier tool-free message gets the same answer
+        embedding = await self._embed(text) if Config.LLM_SEMANTIC_CACHE_SIZE > 0 else None
+        if embedding is not None:
+            # The scan is pure Python, so it runs in a thread over a snapshot of the cache
+            similar = await asyncio.to_thread(self._find_similar, embedding, list(self._semantic_cache))
+            if similar is not None:
+                self._cache_response(cache_key, similar)
+                return dict(similar)
+
+        messages = [*_BASE_MESSAGES, {"role": "user", "content": text}]
+
+        # Cascade: greetings and off-topic chat are answered by the cheap model when it is
+        # confident; everything else (and any doubt) goes to the main model with tools
+        if Config.LLM_MODEL_CHEAP:
+            cheap_answer = await self._ask_cheap_model(messages)
+            if cheap_answer is not None:
+                self._remember(cache_key, embedding, cheap_answer)
+                return cheap_answer
+
+        # Step 1: let the LLM decide whether a tool is needed. The answer is streamed so the
+        # tool can start as soon as its arguments are complete, overlapping the DB work with
+        # the tail of the generation.
+        async with self._llm_slot():
+            stream = await self.client.chat.completions.create(
                 model=Config.LLM_MODEL, # Use configurable model
                 messages=messages,
-                response_format={ "type": "json_object" } # Ensure JSON output
+                tools=self.TOOLS,
+                tool_choice="auto",
+                response_format=self.RESPONSE_FORMAT,
+                stream=True,
+                extra_body=_PROMPT_CACHE_BODY,
             )
-            llm_output = second_response.choices[0].message.content
-        else:
-            llm_output = response_message.content
+            content_parts: List[str] = []
+            tool_calls: Dict[int, Dict[str, Any]] = {}
+            tool_task: Optional["asyncio.Task[str]"] = None
+            try:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        content_parts.append(delta.content)
+                    for tool_call_delta in delta.tool_calls or ():
+                        call = tool_calls.setdefault(
+                            tool_call_delta.index,
+                            {"id": None, "type": "function", "function": {"name": "", "arguments": ""}},
+                        )
+                        if tool_call_delta.id:
+                            call["id"] = tool_call_delta.id
+                        if tool_call_delta.function:
+                            call["function"]["name"] += tool_call_delta.function.name or ""
+                            call["function"]["arguments"] += tool_call_delta.function.arguments or ""
+                    if tool_task is None and 0 in tool_calls:
+                        tool_task = self._start_tool(tool_calls[0])
+            except Exception as e:
+                # The tool is only started from complete arguments, so once it runs a broken
+                # stream (timeout, dropped connection) must not lose its result: the booking
+                # may already be written and the client has to hear about it
+                if tool_task is None:
+                    raise
+                print(f"LLM stream failed after the tool started, using the tool result: {e}")
+            except BaseException:
+                # Cancelled mid-stream: do not leave the started tool running unowned
+                if tool_task is not None:
+                    tool_task.cancel()
+                raise
+
+        if tool_calls:
+            # Step 2: call the tool (only one tool call is expected for simplicity)
+            tool_call = tool_calls[0]
+            function_name = tool_call["function"]["name"]
+            if tool_task is None:
+                function_args = _json_loads(tool_call["function"]["arguments"])
+                tool_task = asyncio.ensure_future(LLMService._TOOL_DISPATCH[function_name](self, **function_args))
+
+            # Step 3: the tool result is the answer. Its status already names the outcome the
+            # bot replies to (booked, available, unavailable, cancelled, changed, error), so no
+            # second LLM round-trip is needed to rephrase it.
+            parsed_data = _json_loads(await tool_task)
+            parsed_data["intent"] = parsed_data.pop("status")
+            return parsed_data
 
+        llm_output = "".join(content_parts)
         try:
-            parsed_data = json.loads(llm_output)
+            parsed_data = _json_loads(llm_output)
+            # Only tool-free answers get here; tool results reflect the reservations and are never cached
+            self._remember(cache_key, embedding, parsed_data)
             return parsed_data
         except json.JSONDecodeError:
             print(f"Error decoding LLM response: {llm_output}")
             return {"intent": "other", "message": llm_output} # Return raw output if not JSON
 
-    def _parse_date(self, date_str: str) -> Optional[datetime]:
-        today = datetime.now(pytz.timezone(Config.TIMEZONE)).date()
-        if date_str.lower() == "сегодня":
-            return datetime.combine(today, datetime.min.time())
-        elif date_str.lower() == "завтра":
-            return datetime.combine(today + timedelta(days=1), datetime.min.time())
-        elif date_str.lower() == "послезавтра":
-            return datetime.combine(today + timedelta(days=2), datetime.min.time())
-        
-        # Try to parse absolute date formats (e.g., '25 октября', '25.10', '25.10.2025')
-        # This part can be more robust, but for now, a simple approach.
+    def _remember(self, cache_key: bytes, embedding: Optional[List[float]], parsed_data: Dict[str, Any]):
+        """Stores a tool-free answer in the exact and (if enabled) semantic caches."""
+        self._cache_response(cache_key, dict(parsed_data))
+        # Only small talk is reused for paraphrases: a booking/cancel/change answer carries
+        # message-specific details that a similar-looking message must not inherit
+        if embedding is not None and parsed_data.get("intent") in ("greeting", "other"):
+            self._semantic_cache.append((embedding, dict(parsed_data)))
+
+    async def _ask_cheap_model(self, messages: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Returns the cheap model's answer for greetings and off-topic chat, or None.
+
+        None means the message needs the main model: the cheap model saw a booking,
+        cancellation or change, was not confident about the intent, or failed.
+        """
         try:
-            # '25 октября'
-            match = re.match(r"(\d{1,2})\s+(января|февраля|марта|апреля|мая|июня|июля|августа|сентября|октября|ноября|декабря)", date_str, re.IGNORECASE)
-            if match:
-                day = int(match.group(1))
-                month_name = match.group(2).lower()
-                month_map = {
-                    "января": 1, "февраля": 2, "марта": 3, "апреля": 4, "мая": 5, "июня": 6,
-                    "июля": 7, "августа": 8, "сентября": 9, "октября": 10, "ноября": 11, "декабря": 12
-                }
-                month = month_map.get(month_name)
-                if month:
-                    year = today.year
-                    # If the month has already passed this year, assume next year
-                    if month < today.month or (month == today.month and day < today.day):
-                        year += 1
-                    return datetime(year, month, day)
-            
-            # '25.10' or '25.10.2025'
-            for fmt in ["%d.%m.%Y", "%d.%m"]:
-                try:
-                    parsed_date = datetime.strptime(date_str, fmt)
-                    if fmt == "%d.%m": # If year is not provided, assume current year
-                        parsed_date = parsed_date.replace(year=today.year)
-                        # If the date has already passed this year, assume next year
-                        if parsed_date.date() < today:
-                            parsed_date = parsed_date.replace(year=today.year + 1)
-                    return parsed_date
-                except ValueError:
-                    continue
+            async with self._llm_slot():
+                response = await self.client.chat.completions.create(
+                    model=Config.LLM_MODEL_CHEAP,
+                    messages=messages,
+                    response_format=self.RESPONSE_FORMAT,
+                    logprobs=True,
+                    extra_body=_PROMPT_CACHE_BODY,
+                )
         except Exception as e:
-            print(f"Error parsing date '{date_str}': {e}")
-            
-        return None
+            print(f"Error calling cheap LLM model: {e}")
+            return None
+        choice = response.choices[0]
+        try:
+            parsed_data = _json_loads(choice.message.content or "")
+        except json.JSONDecodeError:
+            return None
+        if parsed_data.get("intent") not in ("greeting", "other"):
+            return None
+        if _intent_confidence(choice) < Config.LLM_CHEAP_MIN_CONFIDENCE:
+            return None
+        return parsed_data
 
-    def _parse_time(self, time_str: str) -> Optional[datetime]:
+    def _start_tool(self, tool_call: Dict[str, Any]) -> Optional["asyncio.Task[str]"]:
+        """Starts the tool once its streamed arguments form a complete JSON object."""
+        arguments = tool_call["function"]["arguments"]
+        function_to_call = LLMService._TOOL_DISPATCH.get(tool_call["function"]["name"])
+        if function_to_call is None or not arguments.rstrip().endswith("}"):
+            return None
         try:
-            return datetime.strptime(time_str, "%H:%M")
-        except ValueError:
+            function_args = _json_loads(arguments)
+        except json.JSONDecodeError:
             return None
+        return asyncio.ensure_future(function_to_call(self, **function_args))
+
+    def _parse_date(self, date_str: str) -> Optional[date]:
+        return _parse_date_on(date_str, _today())
 
-    def extract_reservation_details(self, text: str) -> Dict[str, Any]:
-        parsed_llm_data = self.parse_reservation_request(text)
+    def _parse_time(self, time_str: str) -> Optional[time]:
+        # 'HH:MM' (one-digit hours/minutes allowed, as with strptime); no strptime machinery
+        hours, sep, minutes = time_str.partition(":")
+        if (
+            sep
+            and 0 < len(hours) <= 2 and 0 < len(minutes) <= 2
+            and hours.isdecimal() and minutes.isdecimal()
+        ):
+            hour, minute = int(hours), int(minutes)
+            if hour < 24 and minute < 60:
+                return time(hour, minute)
+        return None
+
+    async def extract_reservation_details(self, text: str) -> Dict[str, Any]:
+        parsed_llm_data = await self.parse_reservation_request(text)
         
         intent = parsed_llm_data.get("intent", "other")
         
@@ -359,9 +749,7 @@ class LLMService:
             parsed_date = self._parse_date(date_str)
             parsed_time = self._parse_time(time_str)
             if parsed_date and parsed_time:
-                reservation_datetime = pytz.timezone(Config.TIMEZONE).localize(
-                    datetime.combine(parsed_date.date(), parsed_time.time())
-                )
+                reservation_datetime = datetime.combine(parsed_date, parsed_time, tzinfo=_TZ)
 
         return {
             "intent": intent,
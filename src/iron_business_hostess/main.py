@@ -1,11 +1,28 @@
 import asyncio
+import signal
 from iron_business_hostess.telegram_bot import TelegramBot
 
+def configure_event_loop():
+    # uvloop speeds up the socket I/O behind Telethon and AsyncOpenAI; it is optional
+    # (not available on Windows), so fall back to the default asyncio loop without it
+    try:
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 async def main():
     bot = TelegramBot()
+    # docker stop / systemd send SIGTERM: disconnect cleanly so start() can save the database
+    # (add_signal_handler is not available on Windows, where Ctrl+C is the way to stop)
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(bot.stop()))
+    except NotImplementedError:
+        pass
     await bot.start()
 
 if __name__ == '__main__':
+    configure_event_loop()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
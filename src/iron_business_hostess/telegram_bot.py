@@ -14,17 +14,20 @@ logging.basicConfig(format='[%(levelname) 5s/%(asctime)s] %(name)s: %(message)s'
 class TelegramBot:
     def __init__(self):
         self.client = TelegramClient(Config.SESSION_NAME, Config.API_ID, Config.API_HASH)
-        self.db = ReservationDB(Config.TIMEZONE, Config.TABLES, Config.SLOT_DURATION_MINUTES)
+        self.db = ReservationDB(Config.TIMEZONE, Config.TABLES, Config.SLOT_DURATION_MINUTES, in_memory=Config.DB_IN_MEMORY)
         self.llm_service = LLMService(Config.LLM_API_KEY, Config.LLM_BASE_URL, self.db)
 
         self.client.on(events.NewMessage)(self.handle_new_message)
 
-    async def _apply_random_delay(self, response_text: str):
-        base_delay = random.uniform(5, 20) # Random delay between 5 and 20 seconds
-        length_delay = len(response_text) * 0.1 # 0.1 seconds per character
-        total_delay = base_delay + length_delay
+    async def _apply_random_delay(self, chat_id: int):
+        if not Config.HUMAN_DELAY_ENABLED:
+            return
+        # A short "typing..." pause keeps the human feel; the sleep only suspends this
+        # handler, other chats are served meanwhile
+        total_delay = random.uniform(1, 3)
         print(f"Applying random delay of {total_delay:.2f} seconds...")
-        await asyncio.sleep(total_delay)
+        async with self.client.action(chat_id, 'typing'):
+            await asyncio.sleep(total_delay)
 
     async def handle_new_message(self, event):
         sender = await event.get_sender()
@@ -33,11 +36,15 @@ class TelegramBot:
 
         print(f"Received message from {sender.username or sender.id} in chat {chat_id}: {message_text}")
 
-        # Call LLM service to parse request and potentially use tools
-        parsed_data = await self.llm_service.parse_reservation_request(message_text)
+        # Call LLM service to parse request and potentially use tools. The chat shows
+        # "typing..." for the whole LLM round-trip (Telethon re-sends the action every few
+        # seconds), so the wait for the model is visible to the client right away.
+        async with self.client.action(chat_id, 'typing'):
+            parsed_data = await self.llm_service.parse_reservation_request(message_text)
         
         intent = parsed_data.get("intent")
-        response_message = parsed_data.get("message", "Извините, я не совсем поняла ваш запрос.")
+        # Structured output always carries "message", possibly as null
+        response_message = parsed_data.get("message") or "Извините, я не совсем поняла ваш запрос."
 
         if intent == "greeting":
             response = "Здравствуйте! Я хостесс ресторана \"Ромашка\". Могу помочь вам забронировать столик или ответить на вопросы."
@@ -70,14 +77,26 @@ class TelegramBot:
         else: # "other" intent or unexpected
             response = response_message # Use LLM's direct response for "other" or fallback
 
-        await self._apply_random_delay(response)
+        await self._apply_random_delay(chat_id)
         await event.respond(response)
 
     async def start(self):
         print("Starting Telegram Bot...")
         await self.client.start()
+        # Connect to the LLM provider in the background so the first reply skips the TLS handshake
+        self._warm_up_task = asyncio.create_task(self.llm_service.warm_up())
+        persist_task = None
+        if Config.DB_IN_MEMORY:
+            persist_task = asyncio.create_task(self.db.persist_periodically(Config.DB_PERSIST_INTERVAL_SECONDS))
         print("Bot started. Listening for messages...")
-        await self.client.run_until_disconnected()
+        try:
+            await self.client.run_until_disconnected()
+        finally:
+            # Whatever ends the bot (stop(), Ctrl+C, SIGTERM), write the final snapshot so
+            # bookings made since the last periodic one are not lost
+            if persist_task is not None:
+                persist_task.cancel()
+            self.db.persist()
 
     async def stop(self):
         print("Stopping Telegram Bot...")